@@ -1,10 +1,25 @@
-from .wcf import WFC_Sample, WFC_Problem, ShareableList, ndarray
+from .wcf import WFC_Sample, WFC_Problem, NP_ENCODED_TILE_TYPE, ndarray, best_first_search, \
+    intersect_super_tiles_masks, count_center_tiles
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing import get_context
 from .shared_types import TemperatureConfig, SearchWeights
-from py_search.informed import best_first_search
 from threading import Event, Thread
-from _operator import xor
 from comfy import utils
+from comfy.model_management import processing_interrupted, throw_exception_if_processing_interrupted
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain
+import torch
 import numpy as np
+import atexit
+
+
+def view_stop_and_ticker(shm: SharedMemory, ntasks: int) -> ndarray:
+    """
+    @param shm: shared memory block with, at least, 1 + ntasks int64 elements: [ stop flag, ticker 1, ... ]
+    @return: int64 array view of the block, with 1 + ntasks elements. Must be deleted before closing the block.
+    """
+    return np.ndarray((1 + ntasks,), dtype=np.int64, buffer=shm.buf)
 
 
 def waiting_loop(abort_loop_event: Event, pbar: utils.ProgressBar, total_steps, shm_name, ntasks=1):
@@ -13,33 +28,47 @@ def waiting_loop(abort_loop_event: Event, pbar: utils.ProgressBar, total_steps,
     Updates progress_bar via ticker_proxy, updated within Problem instances.
 
     @param abort_loop_event: to be triggered in the main thread once the problem(s) have been solved
-    @param pbar: comfyui progress bar to update every 100 milliseconds
+    @param pbar: comfyui progress bar to update every 100 milliseconds (250 if total_steps is above 10 000)
     @param total_steps: the total number of nodes to process in the problem(s)
-    @param shm_name: shared memory name for a shared list with the elements: [ Boolean, Integer, Integer... ], in this respective order
+    @param shm_name: shared memory name for an int64 array with the elements: [ stop flag, ticker 1, ticker 2... ],
+                     in this respective order; see view_stop_and_ticker
     """
-    from time import sleep
-    from comfy.model_management import processing_interrupted
-    shm_list = ShareableList(name=shm_name)
-    while not abort_loop_event.is_set():
-        sleep(.1)  # pause for 1 second
+    shm = SharedMemory(name=shm_name)
+    stop_and_ticker = view_stop_and_ticker(shm, ntasks)
+    interval = .25 if total_steps > 10_000 else .1  # the progress bar granularity is coarser for large totals
+    while not abort_loop_event.wait(interval):  # returns immediately once the event is set
         if processing_interrupted():
-            shm_list[0] = True
-            return
-        pbar.update_absolute(sum(list(shm_list)[1:ntasks+1]), total_steps)
-    return
+            stop_and_ticker[0] = 1
+            break
+        pbar.update_absolute(int(stop_and_ticker[1:].sum()), total_steps)
+    del stop_and_ticker
+    shm.close()
 
 
-def terminate_generation(finished_event, shm_list, pbt: Thread):
+def terminate_generation(finished_event, shm: SharedMemory, pbt: Thread):
     finished_event.set()
     pbt.join()
-    interrupted = shm_list[0]
-    shm_list.shm.close()
-    shm_list.shm.unlink()
+    stop_and_ticker = view_stop_and_ticker(shm, 0)
+    interrupted = bool(stop_and_ticker[0])
+    del stop_and_ticker
+    shm.close()
+    shm.unlink()
     if interrupted:
-        from comfy.model_management import throw_exception_if_processing_interrupted
         throw_exception_if_processing_interrupted()
 
 
+def images_to_uint8(img_batch) -> list[ndarray]:
+    """
+    @param img_batch: comfyui image batch, a float tensor with values in the range [0, 1]
+    @return: list with the batch's images as uint8 ndarrays, squeezed
+    """
+    arr = img_batch.mul(255.).clamp_(0, 255).to(torch.uint8).cpu().numpy()
+    return [arr[i].squeeze() for i in range(arr.shape[0])]
+
+
+_EMPTY_TILES = torch.empty((1, 1, 1))  # returned when the sample node is not set to output the tiles
+
+
 class WFC_BaseNode:
     FUNCTION = "do"
     CATEGORY = "Bmad/WFC"
@@ -62,18 +91,13 @@ class WFC_SampleNode(WFC_BaseNode):
     RETURN_NAMES = ("sample", "unique_tiles",)
 
     def do(self, img_batch, tile_width, tile_height, output_tiles):
-        import torch
-
-        samples = [np.clip(255. * img_batch[i].cpu().numpy().squeeze(), 0, 255).astype(np.uint8)
-                   for i in range(img_batch.shape[0])]
-        sample = WFC_Sample(samples, tile_width, tile_height)
+        sample = WFC_Sample(images_to_uint8(img_batch), tile_width, tile_height)
 
         if output_tiles:
-            tiles = [torch.from_numpy(tile.astype(np.float32) / 255.0).unsqueeze(0)
-                     for tile, freq in sample.get_tile_data().values()]
-            tiles = torch.concat(tiles)
+            tiles = np.stack([tile for tile, freq in sample.get_tile_data().values()], axis=0)
+            tiles = torch.from_numpy(tiles).to(torch.float32).div_(255.0)
         else:
-            tiles = torch.empty((1, 1, 1))
+            tiles = _EMPTY_TILES
 
         return (sample, tiles,)
 
@@ -120,17 +144,18 @@ class WFC_GenerateNode(WFC_BaseNode):
         if total_tiles_to_proc == 0:
             return (ss,)
 
-        shm_list = ShareableList([False, int(0)])
-        shm_name = shm_list.shm.name
+        shm = SharedMemory(create=True, size=8 * 2)  # zero filled
+        shm_name = shm.name
         finished_event = Event()
         pbar: utils.ProgressBar = utils.ProgressBar(total_tiles_to_proc)
 
         t = Thread(target=waiting_loop, args=(finished_event, pbar, total_tiles_to_proc, shm_name))
         t.start()
 
-        result = generate_single(shm_name, kwargs)
-
-        terminate_generation(finished_event, shm_list, t)
+        try:
+            result = generate_single(shm_name, kwargs)
+        finally:
+            terminate_generation(finished_event, shm, t)
         return (result,)
 
 
@@ -149,7 +174,7 @@ class WFC_Encode(WFC_BaseNode):
     RETURN_NAMES = ("state",)
 
     def do(self, img, sample: WFC_Sample):
-        samples = [np.clip(255. * img[i].cpu().numpy().squeeze(), 0, 255).astype(np.uint8) for i in range(img.shape[0])]
+        samples = images_to_uint8(img[:1])
         encoded = sample.img_to_tile_encoded_world(samples[0])  # no batch enconding, only a single image is encoded
         return (encoded,)
 
@@ -168,11 +193,9 @@ class WFC_Decode(WFC_BaseNode):
     RETURN_TYPES = ("IMAGE", "MASK")
 
     def do(self, state, sample: WFC_Sample):
-        import torch
-
         img, mask = sample.tile_encoded_to_img(state)
-        img = torch.from_numpy(img.astype(np.float32) / 255.0).unsqueeze(0)
-        mask = torch.from_numpy(mask.astype(np.float32) / 255.0).unsqueeze(0)
+        img = torch.from_numpy(img).to(torch.float32).div_(255.0).unsqueeze_(0)
+        mask = torch.from_numpy(mask).to(torch.float32).div_(255.0).unsqueeze_(0)
         return (img, mask,)
 
 
@@ -229,7 +252,7 @@ class WFC_EmptyState(WFC_BaseNode):
     RETURN_NAMES = ("state",)
 
     def do(self, width, height):
-        return (np.zeros((width, height)),)
+        return (np.zeros((width, height), dtype=NP_ENCODED_TILE_TYPE),)
 
 
 class WFC_Filter(WFC_BaseNode):
@@ -248,23 +271,68 @@ class WFC_Filter(WFC_BaseNode):
     RETURN_NAMES = ("state",)
 
     def do(self, state: ndarray, tiles_batch, invert):
-        to_filter = [WFC_Sample.tile_to_hash(
-            np.clip(255. * tiles_batch[i].cpu().numpy().squeeze(), 0, 255).astype(np.uint8))
-            for i in range(tiles_batch.shape[0])]
-        new_state = [t if xor(t in to_filter, invert) else 0 for t in state.flatten()]
-        new_state = np.array(new_state).reshape(state.shape)
-        return (new_state,)
+        keys = WFC_Sample.tiles_to_hashes(images_to_uint8(tiles_batch)).astype(state.dtype)
+        return (np.where(np.isin(state, keys, invert=invert), state, 0),)
+
+
+def share_array(array: ndarray) -> tuple[SharedMemory, tuple[str, tuple[int, ...], str]]:
+    """
+    Copies the array into a new shared memory block.
+    @return: the shared memory block, which must be closed & unlinked by the caller;
+             and a (name, shape, dtype) descriptor, that can be sent to other processes to read the array.
+    """
+    shm = SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def read_shared_array(descriptor: tuple[str, tuple[int, ...], str]) -> ndarray:
+    """
+    @param descriptor: the descriptor returned by share_array
+    @return: a copy of the shared array
+    """
+    name, shape, dtype = descriptor
+    shm = SharedMemory(name=name)
+    shared = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array = shared.copy()
+    del shared  # the buffer can't be closed while exported
+    shm.close()
+    return array
 
 
-def generate_single(stop_and_ticker_shm_name, i_kwargs, pid=0): #stop, ticker,
-    shm_list = ShareableList(name=stop_and_ticker_shm_name)
-    i_kwargs.update({"stop_and_ticker_shm_list": shm_list})
+def generate_single(stop_and_ticker_shm_name, i_kwargs, pid=0, starting_state_descriptor=None,
+                    masks_descriptors=None): #stop, ticker,
+    """
+    @param starting_state_descriptor: if set, the starting state is read from shared memory (see share_array)
+                                      instead of being passed via i_kwargs.
+    @param masks_descriptors: if set, the sample's super tiles bitmasks and spans are read from shared memory;
+                              these are not pickled with the sample, see WFC_Sample.__getstate__.
+    """
+    if starting_state_descriptor is not None:
+        i_kwargs["starting_state"] = read_shared_array(starting_state_descriptor)
+    if masks_descriptors is not None:
+        i_kwargs["sample"].set_super_tiles_masks(*map(read_shared_array, masks_descriptors))
+    shm = SharedMemory(name=stop_and_ticker_shm_name)
     i_kwargs.update({"pid": pid})
-    problem = WFC_Problem(**i_kwargs)
+    problem = None
+    try:
+        problem = WFC_Problem(**i_kwargs)
+        # attached once built, so that the problem holds the only reference to the view
+        problem.set_stop_and_ticker(view_stop_and_ticker(shm, pid + 1))
+        return solve_single(problem, i_kwargs["starting_state"])
+    finally:
+        # the buffer can't be closed while exported, and the problem may outlive this call
+        if problem is not None:
+            problem.set_stop_and_ticker(None)
+        del problem
+        shm.close()
+
+
+def solve_single(problem: WFC_Problem, starting_state: ndarray):
     if problem._number_of_tiles_to_process == 0:
-        return i_kwargs["starting_state"]
+        return starting_state
     try:
-        next(best_first_search(problem, graph=True))  # find 1st solution
+        next(best_first_search(problem))  # find 1st solution
     except InterruptedError:
         return None
     except StopIteration:
@@ -272,16 +340,52 @@ def generate_single(stop_and_ticker_shm_name, i_kwargs, pid=0): #stop, ticker,
     except KeyError:
         print("\33[33m"
               "[wfc_like] WARNING: search exited early due to a key error."
-              " This is likely caused by a hashcode collision; if this is a problem"
-              ", changing the seed will likely solve it."
               " \33[0m")
-        # note that some collisions may not originate an error, and might even allow the return of an invalid state.
-        # such occurrences should be very rare though.
 
     result = problem.get_solution_state()
     return result
 
 
+def _preload_modules():
+    """
+    Worker initializer; loads the jit compiled kernels once per worker, instead of during its first generation.
+    """
+    intersect_super_tiles_masks(np.zeros((9, 1, 1), dtype=np.uint64), np.zeros((9, 1, 2), dtype=np.intp),
+                                np.zeros(1, dtype=np.intp), np.zeros(1, dtype=np.intp))
+    count_center_tiles(np.zeros(1, dtype=np.uint64), np.zeros((1, 9), dtype=np.intp), np.zeros(1, dtype=np.int64), 1)
+
+
+def generate_parallel(stop_and_ticker_shm_name, per_gen_inputs, executor: ProcessPoolExecutor):
+    """
+    Runs generate_single for each of the given inputs in the given pool of processes.
+    The starting states, and the samples' super tiles bitmasks & spans, are sent via shared memory;
+    each unique state and sample is only copied once.
+    """
+    shared_states = {}
+    shared_masks = {}
+    descriptors = []
+    masks_descriptors = []
+    for input_i in per_gen_inputs:
+        state = input_i.pop("starting_state")
+        if id(state) not in shared_states:
+            shared_states[id(state)] = share_array(state)
+        descriptors.append(shared_states[id(state)][1])
+
+        sample = input_i["sample"]
+        if id(sample) not in shared_masks:
+            shared_masks[id(sample)] = [share_array(array) for array in sample.get_super_tiles_tables()[4:]]
+        masks_descriptors.append([descriptor for _, descriptor in shared_masks[id(sample)]])
+
+    try:
+        futures = [executor.submit(generate_single, stop_and_ticker_shm_name, input_i, i, descriptor, m_descriptors)
+                   for i, (input_i, descriptor, m_descriptors)
+                   in enumerate(zip(per_gen_inputs, descriptors, masks_descriptors))]
+        return [future.result() for future in futures]
+    finally:
+        for shm, _ in chain(shared_states.values(), *shared_masks.values()):
+            shm.close()
+            shm.unlink()
+
 
 class WFC_GenParallel(WFC_BaseNode):
     @classmethod
@@ -295,9 +399,29 @@ class WFC_GenParallel(WFC_BaseNode):
     INPUT_IS_LIST = True
     OUTPUT_IS_LIST = (True,)
 
-    def do(self, max_parallel_tasks, custom_temperature_config=None, custom_node_value_config=None, **kwargs):
-        from joblib import Parallel, delayed
+    _executor: ProcessPoolExecutor | None = None
+    _executor_max_workers: int = 0
+
+    @classmethod
+    def get_executor(cls, max_workers: int) -> ProcessPoolExecutor:
+        """
+        @return: a pool of processes reused across calls; only recreated when the number of workers changes.
+                 The workers are fresh interpreters ("spawn"), instead of forks of the multithreaded host process.
+        """
+        if cls._executor is None or cls._executor_max_workers != max_workers:
+            cls.shutdown_executor()
+            cls._executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context("spawn"),
+                                                initializer=_preload_modules)
+            cls._executor_max_workers = max_workers
+        return cls._executor
+
+    @classmethod
+    def shutdown_executor(cls):
+        if cls._executor is not None:
+            cls._executor.shutdown()
+            cls._executor = None
 
+    def do(self, max_parallel_tasks, custom_temperature_config=None, custom_node_value_config=None, **kwargs):
         max_parallel_tasks = max_parallel_tasks[0]
         ct_len = 0 if custom_temperature_config is None else len(custom_temperature_config)
         cnv_len = 0 if custom_node_value_config is None else len(custom_node_value_config)
@@ -309,8 +433,10 @@ class WFC_GenParallel(WFC_BaseNode):
 
         # TODO count is also done inside Problem, maybe should use as optional arg to avoid repeating the operation
         ss = kwargs["starting_state"]
-        total_tiles_to_proc = sum([i.size - np.count_nonzero(i) for i in ss])
-        total_tiles_to_proc += (ss[-1].size - np.count_nonzero(ss[-1])) * (max_len - len(ss))
+        sizes = np.fromiter((i.size for i in ss), dtype=np.int64, count=len(ss))
+        non_zeroes = np.fromiter((np.count_nonzero(i) for i in ss), dtype=np.int64, count=len(ss))
+        total_tiles_to_proc = int(sizes.sum() - non_zeroes.sum())
+        total_tiles_to_proc += int(sizes[-1] - non_zeroes[-1]) * (max_len - len(ss))
 
         items = kwargs.items()
         per_gen_inputs = []
@@ -322,17 +448,27 @@ class WFC_GenParallel(WFC_BaseNode):
                 input_i.update(custom_node_value_config[min(i, cnv_len - 1)])
             per_gen_inputs.append(input_i)
 
-        shm_list = ShareableList([False] + [int(0)]*max_len)
-        shm_name = shm_list.shm.name
+        shm = SharedMemory(create=True, size=8 * (1 + max_len))  # zero filled
+        shm_name = shm.name
 
         finished_event = Event()
         pbar: utils.ProgressBar = utils.ProgressBar(total_tiles_to_proc)
         t = Thread(target=waiting_loop, args=(finished_event, pbar, total_tiles_to_proc, shm_name, max_len))
         t.start()
 
-        final_result = Parallel(n_jobs=max_parallel_tasks)(
-            delayed(generate_single)(shm_name, per_gen_inputs[i], i) for i in range(max_len))
-
-        terminate_generation(finished_event, shm_list, t)
+        try:
+            if max_len == 1:  # no benefit in using a separate process
+                final_result = [generate_single(shm_name, per_gen_inputs[0])]
+            else:
+                try:
+                    final_result = generate_parallel(shm_name, per_gen_inputs, self.get_executor(max_parallel_tasks))
+                except BrokenProcessPool:
+                    self.shutdown_executor()  # a worker died abruptly, the pool can't be reused
+                    raise
+        finally:
+            terminate_generation(finished_event, shm, t)
         return (final_result,)
 
+
+atexit.register(WFC_GenParallel.shutdown_executor)
+
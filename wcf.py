@@ -1,18 +1,20 @@
 from .shared_types import TemperatureConfig, SearchWeights
-from multiprocessing.shared_memory import ShareableList
-from py_search.base import Problem, Node
-from functools import lru_cache, cache
-from collections import defaultdict
+from collections import OrderedDict
+from itertools import count, chain
+from operator import itemgetter
 from typing import TypeAlias, Callable
 from numpy import ndarray
+from numpy.lib.stride_tricks import sliding_window_view
+from numba import njit
 import numpy as np
-import hashlib
+import xxhash
+import heapq
 
 # region Type Aliases and Constants
 
-CellPotentialStatesData: TypeAlias = tuple[list[bytes], ndarray | None, float | None]
+CellPotentialStatesData: TypeAlias = tuple[list[int], ndarray, float, float | None, ndarray]
 """
-( 0:states, 1:costs, 2:entropy)
+( 0:states, 1:probabilities, 2:entropy, 3:normalized entropy, 4:states' tile indices)
 """
 Index2D: TypeAlias = tuple[int, int]
 """
@@ -24,8 +26,178 @@ a tile's hash
 """
 WFC_Action: TypeAlias = tuple[Index2D, TileType]
 
-TILE_DIGEST_SIZE = 4  # in bytes
-NP_ENCODED_TILE_TYPE = "longlong"
+TILE_DIGEST_SIZE = 8  # in bytes
+TILE_HASH_COLLISION_ERROR = ("[wfc_like] different tiles share the same hashcode, or a tile's hashcode is zero (empty);"
+                             " the tiles would be merged into a single tile type.")
+NP_ENCODED_TILE_TYPE = "uint64"  # must hold TILE_DIGEST_SIZE bytes
+SUPER_TILES_MASKS_WARNING_SIZE = 256 * 1024 ** 2  # in bytes
+"""
+The super tiles bitmasks' size grows with the number of tiles times the number of super tiles;
+a warning is printed above this size. See build_super_tiles_masks.
+"""
+ADJACENT_OFFSETS_8: tuple[Index2D, ...] = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+"""
+(dy, dx) offsets of the 8 adjacent tiles, in row-major order; matches the 3x3 roi slots without the center
+"""
+ADJACENT_OFFSETS_4: tuple[Index2D, ...] = ((-1, 0), (0, -1), (0, 1), (1, 0))
+PREPARE_CACHE_MAX_SIZE = 16
+_PREPARE_CACHE: OrderedDict[tuple, tuple] = OrderedDict()
+"""
+WFC_Sample.prepare results of the most recently used images; see WFC_Sample.prepare
+"""
+
+# endregion
+
+
+# region Utils
+
+def unique_rows(array: ndarray, return_index: bool = False, return_inverse: bool = False, return_counts: bool = False):
+    """
+    Same as np.unique(array, axis=0, ...) for arrays of non-negative integers, but faster.
+    The rows are viewed as single void elements, which are sorted as bytes instead of lexicographically by column;
+    the values are stored as big-endian so that both orders match.
+    @return: the unique rows; followed by the first occurrences' indices, inverse indices and counts, if requested
+    """
+    rows = np.ascontiguousarray(array.reshape(len(array), -1), dtype=array.dtype.newbyteorder(">"))
+    voids = rows.view(np.dtype((np.void, rows.itemsize * rows.shape[1]))).ravel()
+    _, index, inverse, counts = np.unique(voids, return_index=True, return_inverse=True, return_counts=True)
+    result = ((array[index],) + ((index,) if return_index else ())
+              + ((inverse,) if return_inverse else ()) + ((counts,) if return_counts else ()))
+    return result if len(result) > 1 else result[0]
+
+
+def zobrist_keys(position_key: np.uint64, tile_indices: ndarray) -> ndarray:
+    """
+    Zobrist keys of placing the given tiles at a position, without storing a key per position and tile.
+    The position's key is mixed with each tile index via splitmix64's finalizer, a bijection,
+    so the keys are distinct for the tiles of a position and look random across positions.
+    @param position_key: random 64-bit key of the position
+    @param tile_indices: the tiles' indices, in the range [0, T[
+    @return: uint64 array with a key per tile index
+    """
+    z = tile_indices.astype(np.uint64) ^ position_key
+    z ^= z >> np.uint64(30)
+    z *= np.uint64(0xbf58476d1ce4e5b9)
+    z ^= z >> np.uint64(27)
+    z *= np.uint64(0x94d049bb133111eb)
+    z ^= z >> np.uint64(31)
+    return z
+
+# endregion
+
+
+# region Super Tiles Bitmasks
+
+def build_super_tiles_masks(super_tile_data: list[tuple[ndarray, int]], tile_index: dict[TileType, int]
+                            ) -> tuple[ndarray, ndarray, ndarray]:
+    """
+    Bitmasks used to intersect, with bitwise ands, the super tiles that match a partially known 3x3 neighborhood.
+    @param super_tile_data: list of (super tile, count) pairs
+    @param tile_index: maps each tile hash into an index in the range [0, T[
+    @return: the super tiles as a (S, 9) matrix of tile indices, their counts,
+             and a (9, T, ceil(S/64)) uint64 array where the bits of [slot, tile] are set
+             for the super tiles that have the given tile at the given slot.
+             The bitmasks take 9 * T * ceil(S/64) * 8 bytes, e.g. 280 MB for T and S around 16k;
+             and are copied into each process running a generation.
+    """
+    n_super_tiles = len(super_tile_data)
+    masks_size = 9 * len(tile_index) * ((n_super_tiles + 63) // 64) * 8
+    if masks_size > SUPER_TILES_MASKS_WARNING_SIZE:
+        print("\33[33m"
+              f"[wfc_like] WARNING: the sample's super tiles bitmasks take {masks_size / 1024 ** 2:,.0f} MB"
+              f" ({len(tile_index):,} tiles and {n_super_tiles:,} super tiles), and are copied into each parallel task;"
+              " consider using a larger tile size or a less noisy sample."
+              " \33[0m")
+    # map the super tiles' hashes into tile indices; every hash in the super tiles must be in tile_index
+    tile_hashes = np.fromiter(tile_index.keys(), dtype=NP_ENCODED_TILE_TYPE, count=len(tile_index))
+    tile_ids = np.fromiter(tile_index.values(), dtype=np.intp, count=len(tile_index))
+    hashes_order = np.argsort(tile_hashes)
+    stiles_hashes = np.stack([stile for stile, _ in super_tile_data]).reshape(n_super_tiles, 9)
+    super_tiles = tile_ids[hashes_order[np.searchsorted(tile_hashes, stiles_hashes, sorter=hashes_order)]]
+    counts = np.fromiter((count for _, count in super_tile_data), dtype=np.int64, count=n_super_tiles)
+
+    masks = np.zeros((9, len(tile_index), (n_super_tiles + 63) // 64), dtype=np.uint64)
+    stile_ids = np.arange(n_super_tiles)
+    bits = np.left_shift(np.uint64(1), (stile_ids & 63).astype(np.uint64))
+    for slot in range(9):
+        np.bitwise_or.at(masks, (slot, super_tiles[:, slot], stile_ids >> 6), bits)
+    return super_tiles, counts, masks
+
+
+def build_super_tiles_spans(masks: ndarray) -> ndarray:
+    """
+    @param masks: (9, T, W64) super tiles bitmasks, obtained via build_super_tiles_masks
+    @return: (9, T, 2) array with the [first, last + 1[ range of the non-zero words of each mask; (0, 0) if none
+    """
+    non_zero = masks != 0
+    n_words = masks.shape[2]
+    spans = np.empty((*masks.shape[:2], 2), dtype=np.intp)
+    spans[..., 0] = np.argmax(non_zero, axis=2)
+    spans[..., 1] = n_words - np.argmax(non_zero[..., ::-1], axis=2)
+    spans[~non_zero.any(axis=2)] = 0
+    return spans
+
+
+@njit(cache=True, boundscheck=False)
+def intersect_super_tiles_masks(masks: ndarray, spans: ndarray, slots: ndarray, tiles: ndarray) -> ndarray:
+    """
+    Only the words within the intersection of the masks' non-zero spans are processed;
+    the words outside are zero in at least one of the masks.
+    @param masks: (9, T, W64) super tiles bitmasks, obtained via build_super_tiles_masks
+    @param spans: the masks' non-zero spans, obtained via build_super_tiles_spans
+    @param slots: the slots of the known tiles; must not be empty
+    @param tiles: the indices of the known tiles
+    @return: the bitwise and of masks[slots[i], tiles[i]] for all i
+    """
+    lo, hi = 0, masks.shape[2]
+    for i in range(slots.size):
+        lo = max(lo, spans[slots[i], tiles[i], 0])
+        hi = min(hi, spans[slots[i], tiles[i], 1])
+
+    domain = np.zeros(masks.shape[2], dtype=np.uint64)
+    if lo >= hi:
+        return domain
+
+    domain[lo:hi] = masks[slots[0], tiles[0], lo:hi]
+    for i in range(1, slots.size):
+        mask = masks[slots[i], tiles[i]]
+        any_set = False
+        for w in range(lo, hi):
+            domain[w] &= mask[w]
+            any_set |= domain[w] != 0
+        if not any_set:
+            break
+    return domain
+
+
+@njit(cache=True, boundscheck=False)
+def count_center_tiles(domain: ndarray, super_tiles: ndarray, counts: ndarray, n_tiles: int
+                       ) -> tuple[ndarray, ndarray]:
+    """
+    @param domain: bitmask of super tiles, obtained via intersect_super_tiles_masks
+    @param super_tiles: (S, 9) super tiles' tile indices, obtained via build_super_tiles_masks
+    @param counts: the super tiles' counts
+    @param n_tiles: number of tiles (T)
+    @return: the indices of the center tiles in the domain, ordered by first occurrence;
+             and the summed counts of the domain's super tiles per center tile index
+    """
+    tile_counts = np.zeros(n_tiles, dtype=np.int64)
+    order = np.empty(n_tiles, dtype=np.intp)
+    n_found = 0
+    one = np.uint64(1)
+    for w in range(domain.size):
+        word = domain[w]
+        i = w * 64
+        while word != 0:
+            if word & one:
+                tile = super_tiles[i, 4]
+                if tile_counts[tile] == 0:  # counts are positive, so a zero count means not found yet
+                    order[n_found] = tile
+                    n_found += 1
+                tile_counts[tile] += counts[i]
+            word >>= one
+            i += 1
+    return order[:n_found], tile_counts
 
 
 # endregion
@@ -40,29 +212,50 @@ class WFC_Sample:
 
     @staticmethod
     def tile_to_hash(tile) -> TileType:
-        return int.from_bytes(hashlib.blake2b(tile.tobytes(), digest_size=TILE_DIGEST_SIZE).digest(), byteorder="big")
+        # hashes the array's buffer directly; only copied if not contiguous, unlike tobytes
+        return xxhash.xxh3_64_intdigest(np.ascontiguousarray(tile))
 
     def __init__(self, src_imgs, cell_width, cell_height):
         self.tile_data, self.super_tile_data, self.tile_dims = self.prepare(src_imgs[0], cell_width, cell_height)
 
         for img in src_imgs[1:]:
             r_tile_data, r_super_tile_data, _ = self.prepare(img, cell_width, cell_height)
+            if any(not np.array_equal(self.tile_data[k][0], v[0])
+                   for k, v in r_tile_data.items() if k in self.tile_data):
+                raise ValueError(TILE_HASH_COLLISION_ERROR)
             self.tile_data = {k: (v[0], self.tile_data.get(k, (None, 0))[1] + v[1])
                               for k, v in {**self.tile_data, **r_tile_data}.items()}
             self.super_tile_data = self.merge_tuples(self.super_tile_data, r_super_tile_data)
 
+        self._tile_hashes: list[TileType] = list(self.tile_data.keys())
+        self._tile_index: dict[TileType, int] = {t: i for i, t in enumerate(self._tile_hashes)}
+        self._super_tiles_indices, self._super_tiles_counts, self._super_tiles_masks = \
+            build_super_tiles_masks(self.super_tile_data, self._tile_index)
+        self._super_tiles_spans = build_super_tiles_spans(self._super_tiles_masks)
+        """
+        Super tiles bitmasks, built once per sample and shared by the problems using it;
+        see build_super_tiles_masks and build_super_tiles_spans.
+        """
+
+        self._sorted_tile_hashes = np.array(sorted(self._tile_hashes), dtype=NP_ENCODED_TILE_TYPE)
+        self._tiles_lut = np.stack([self.tile_data[t][0] for t in self._sorted_tile_hashes.tolist()]
+                                   + [np.zeros_like(next(iter(self.tile_data.values()))[0])], axis=0)
+        """
+        The sample's tiles sorted by hash, followed by an empty tile used for unknown hashes; see tile_encoded_to_img.
+        """
+
     @staticmethod
     def merge_tuples(list1, list2):  # adapted from GPT; might be wrong
-        result_dict = defaultdict(int)
-        shape = list1[0][0].shape
-        for ndarray, value in list1 + list2:
-            # Convert ndarray to a hashable type (tuple)
-            key = tuple(ndarray.flatten())
-            result_dict[key] += value
+        arrays = np.stack([array for array, _ in chain(list1, list2)])
+        values = np.fromiter((value for _, value in chain(list1, list2)), dtype=np.int64, count=len(arrays))
+        unique_arrays, first_index, inverse = unique_rows(arrays, return_index=True, return_inverse=True)
+        summed_values = np.bincount(inverse, weights=values).astype(np.int64)
 
-        # Convert the result back to a list of tuples
-        result_list = [(np.array(key).reshape(shape), value) for key, value in result_dict.items()]
-        return result_list
+        # keep the order of the first occurrences, as when merging into a dictionary
+        order = np.argsort(first_index)
+        unique_arrays = unique_arrays[order]
+        unique_arrays.flags.writeable = False
+        return list(zip(unique_arrays, summed_values[order]))
 
     def get_tile_data(self) -> dict[TileType, tuple[ndarray, float]]:
         """
@@ -70,16 +263,56 @@ class WFC_Sample:
         """
         return self.tile_data
 
+    @staticmethod
+    def tiles_to_hashes(tiles) -> ndarray:
+        """
+        Same as tile_to_hash for each of the given tiles, but repeated tiles are only hashed once.
+        @param tiles: array, or sequence, of tiles with the same shape and dtype
+        @return: array with the tiles' hashes, in the same order
+        """
+        utiles, inverse = unique_rows(np.asarray(tiles), return_inverse=True)
+        ut_hashes = np.fromiter(map(WFC_Sample.tile_to_hash, utiles), dtype=NP_ENCODED_TILE_TYPE, count=len(utiles))
+        return ut_hashes[inverse]
+
     def get_super_tile_data(self) -> list[tuple[ndarray, int]]:
         """
         @return: list of (super tile, count) pairs
         """
         return self.super_tile_data
 
+    def get_super_tiles_tables(self) -> tuple[list[TileType], dict[TileType, int], ndarray, ndarray, ndarray, ndarray]:
+        """
+        @return: the tile hashes, a tile hash to index dictionary,
+                 and the super tiles' indices, counts, bitmasks and bitmasks' spans;
+                 see build_super_tiles_masks and build_super_tiles_spans
+        """
+        if self._super_tiles_masks is None:  # not pickled, see __getstate__
+            self.set_super_tiles_masks(build_super_tiles_masks(self.super_tile_data, self._tile_index)[2])
+        return (self._tile_hashes, self._tile_index, self._super_tiles_indices, self._super_tiles_counts,
+                self._super_tiles_masks, self._super_tiles_spans)
+
+    def set_super_tiles_masks(self, masks: ndarray, spans: ndarray = None) -> None:
+        """
+        @param masks: the sample's super tiles bitmasks, e.g. when unpickled, instead of rebuilding them
+        @param spans: the masks' spans; computed from the masks if not given
+        """
+        self._super_tiles_masks = masks
+        self._super_tiles_spans = build_super_tiles_spans(masks) if spans is None else spans
+
+    def __getstate__(self):
+        """
+        The super tiles bitmasks are excluded; these are often the sample's largest data, and can be rebuilt.
+        See set_super_tiles_masks.
+        """
+        state = self.__dict__.copy()
+        state["_super_tiles_masks"] = state["_super_tiles_spans"] = None
+        return state
+
     @staticmethod
-    def adjust_image_to_tile_size(img, tile_height, tile_width):
+    def image_size_in_tiles(img, tile_height, tile_width):
         """
-        @return: the adjusted image, height in number of cells, and width
+        Warns if the image's dimensions are not divisible by the tile's; the remainder is cropped when adjusting.
+        @return: height in number of cells, and width
         """
         if img.shape[0] % tile_height != 0:
             print(f"src height ({img.shape[0]}) is not divisible by cell_height ({tile_height})!")
@@ -89,6 +322,14 @@ class WFC_Sample:
         height_in_tiles = img.shape[0] // tile_height
         width_in_tiles = img.shape[1] // tile_width
         assert height_in_tiles >= 3 and width_in_tiles >= 3, "sample too small to infer adjacency rules."
+        return height_in_tiles, width_in_tiles
+
+    @staticmethod
+    def adjust_image_to_tile_size(img, tile_height, tile_width):
+        """
+        @return: the adjusted image, height in number of cells, and width
+        """
+        height_in_tiles, width_in_tiles = WFC_Sample.image_size_in_tiles(img, tile_height, tile_width)
 
         new_height = tile_height * height_in_tiles
         new_width = tile_width * width_in_tiles
@@ -98,30 +339,58 @@ class WFC_Sample:
 
     @staticmethod
     def prepare(src_img, tile_width, tile_height):
+        """
+        Same as _prepare, but the results are cached, keyed by the image's contents and the tile dimensions.
+        The cached results are shared, and must not be modified.
+        """
+        src_img = np.ascontiguousarray(src_img)
+        # checked before the lookup, so that the size warnings are also shown when the results are cached
+        ycell_len, xcell_len = WFC_Sample.image_size_in_tiles(src_img, tile_height, tile_width)
+        key = (xxhash.xxh3_128_intdigest(src_img), src_img.shape, src_img.dtype.str, tile_width, tile_height)
+        prepared = _PREPARE_CACHE.get(key)
+        if prepared is None:
+            prepared = WFC_Sample._prepare(src_img[:ycell_len * tile_height, :xcell_len * tile_width],
+                                           tile_width, tile_height)
+            _PREPARE_CACHE[key] = prepared
+            if len(_PREPARE_CACHE) > PREPARE_CACHE_MAX_SIZE:
+                _PREPARE_CACHE.popitem(last=False)
+        else:
+            _PREPARE_CACHE.move_to_end(key)
+        return prepared
+
+    @staticmethod
+    def _prepare(src_img, tile_width, tile_height):
+        """
+        @param src_img: image with dimensions divisible by the tile's; see image_size_in_tiles
+        """
         src_shape = src_img.shape
-        adjusted_img, ycell_len, xcell_len = WFC_Sample.adjust_image_to_tile_size(src_img, tile_height, tile_width)
-        tiles = adjusted_img.reshape(
+        ycell_len, xcell_len = src_shape[0] // tile_height, src_shape[1] // tile_width
+        tiles = src_img.reshape(
             (
-                ycell_len,  # adjusted_img.shape[0] // tile_height,
+                ycell_len,  # src_shape[0] // tile_height,
                 tile_height,
-                xcell_len,  # adjusted_img.shape[1] // tile_width,
+                xcell_len,  # src_shape[1] // tile_width,
                 tile_width,
                 src_shape[2]
             )
         ).swapaxes(1, 2)
         size_in_tiles = tiles.shape[:2]
         tiles = tiles.reshape(-1, tile_height, tile_width, src_shape[2])
-        utiles, counts = np.unique(tiles, axis=0, return_counts=True)
-        ut_hashes = [WFC_Sample.tile_to_hash(tile) for tile in utiles]
+        utiles, inverse, counts = unique_rows(tiles, return_inverse=True, return_counts=True)
+        utiles.flags.writeable = False
+        # only the unique tiles are hashed, the image's tiles are then mapped to their hashes via the inverse indices
+        ut_hashes = np.fromiter(map(WFC_Sample.tile_to_hash, utiles), dtype=NP_ENCODED_TILE_TYPE, count=len(utiles))
+        # utiles are unique, so any repeated hash is a collision; zero is reserved for empty cells
+        if np.unique(ut_hashes).size != ut_hashes.size or not ut_hashes.all():
+            raise ValueError(TILE_HASH_COLLISION_ERROR)
 
-        tiles_data = dict(zip(ut_hashes, zip(utiles, counts / tiles.shape[0])))
-        hashed_tiles = np.array([WFC_Sample.tile_to_hash(tile) for tile in tiles])
-        hashed_tiles = hashed_tiles.reshape(size_in_tiles)
+        tiles_data = dict(zip(ut_hashes.tolist(), zip(utiles, counts / tiles.shape[0])))
+        hashed_tiles = ut_hashes[inverse].reshape(size_in_tiles)
 
-        super_tiles = np.array(
-            [hashed_tiles[y:y + 3, x:x + 3] for y in range(size_in_tiles[0] - 2) for x in range(size_in_tiles[1] - 2)])
+        super_tiles = sliding_window_view(hashed_tiles, (3, 3)).reshape(-1, 3, 3)  # all 3x3 windows, row-major
 
-        u_super_tiles, super_counts = np.unique(super_tiles, axis=0, return_counts=True)
+        u_super_tiles, super_counts = unique_rows(super_tiles, return_counts=True)
+        u_super_tiles.flags.writeable = False
         super_tiles_data = list(zip(u_super_tiles, super_counts))
 
         return tiles_data, super_tiles_data, (tile_height, tile_width, src_shape[2])
@@ -139,28 +408,55 @@ class WFC_Sample:
         ).swapaxes(1, 2)
         size_in_tiles = tiles.shape[:2]
         tiles = tiles.reshape(-1, self.tile_dims[0], self.tile_dims[1], adjusted_img.shape[2])
-        hashed_world = [WFC_Sample.tile_to_hash(tile) for tile in tiles]
-        hashed_world = np.array([tile if tile in self.tile_data.keys() else 0 for tile in hashed_world]).astype(
-            NP_ENCODED_TILE_TYPE)
-        return hashed_world.reshape(*size_in_tiles)
+        utiles, inverse = unique_rows(tiles, return_inverse=True)
+        # only the unique tiles are hashed; those not present in the sample are encoded as empty (0)
+        ut_hashes = np.fromiter(map(self.tile_to_hash, utiles), dtype=NP_ENCODED_TILE_TYPE, count=len(utiles))
+        ut_hashes[~np.isin(ut_hashes, self._sorted_tile_hashes)] = 0
+        return ut_hashes[inverse].reshape(*size_in_tiles)
 
     def tile_encoded_to_img(self, src_state: ndarray):
+        """
+        @return: the decoded image, with the tiles' dtype, and an uint8 mask that is 255 where the tiles are unknown
+        """
         th, tw = self.tile_dims[:2]
-        img = np.zeros((src_state.shape[0] * th, src_state.shape[1] * tw, self.tile_dims[2]))
-        mask = np.ones((src_state.shape[0] * th, src_state.shape[1] * tw)) * 255
-        for (y, x), hashcode in np.ndenumerate(src_state):
-            if hashcode in self.tile_data:
-                img[y * th:(y + 1) * th, x * tw:(x + 1) * tw] = self.tile_data[hashcode][0]
-                mask[y * th:(y + 1) * th, x * tw:(x + 1) * tw] = np.zeros(self.tile_data[hashcode][0].shape[:2])
+        (h, w), n_tiles = src_state.shape, self._sorted_tile_hashes.size
+        # map each hashcode into its index in the lut; unknown hashcodes are mapped into the trailing empty tile
+        lut_indices = np.searchsorted(self._sorted_tile_hashes, src_state).clip(max=n_tiles - 1)
+        known = self._sorted_tile_hashes[lut_indices] == src_state
+        lut_indices[~known] = n_tiles
+
+        img = self._tiles_lut[lut_indices].swapaxes(1, 2).reshape(h * th, w * tw, self.tile_dims[2])
+        mask = np.where(known, 0, 255).astype(np.uint8).repeat(th, axis=0).repeat(tw, axis=1)
         return img, mask
 
 
-class WFC_Problem(Problem):
+class Node:
+    """
+    A search node. Stores the action that led to it instead of the world state.
+    """
+    __slots__ = ("state", "parent", "action", "node_cost", "extra", "node_depth")
+
+    def __init__(self, state, parent: "Node" = None, action: WFC_Action = None, node_cost: float = 0, extra=None):
+        self.state = state
+        self.parent = parent
+        self.action = action
+        self.node_cost = node_cost
+        self.extra = extra
+        self.node_depth = 0 if parent is None else parent.node_depth + 1
+
+    def depth(self) -> int:
+        return self.node_depth
+
+    def cost(self) -> float:
+        return self.node_cost
+
+
+class WFC_Problem:
     def __init__(self, sample: WFC_Sample, starting_state: ndarray, seed: int = 0, use_8_cardinals: bool = False,
                  relax_validation: bool = False, max_freq_adjust: float = 1, plateau_check_interval: int = -1,
                  tconf: TemperatureConfig = TemperatureConfig(50, 0, 80),
                  weights: SearchWeights = SearchWeights(1, 1, 0),
-                 stop_and_ticker_shm_list: ShareableList = None, pid: int = 0
+                 stop_and_ticker: ndarray = None, pid: int = 0
                  ):
         """
         @param sample: contains the tiles, their frequencies and "implicit" constraints
@@ -174,11 +470,11 @@ class WFC_Problem(Problem):
                                        if the depth hasn't changed between checks, the search is stopped.
                                        Set to 0 (zero) to ignore plateau checks.
                                        Set to -1 (minus 1) to auto select depending on the number of nodes to process.
-        @param stop_and_ticker_shm_list: shared memory list.
-                                        element at index=0 indicates whether to execution as been canceled or not.
-                                        elements at index>1 will store the best depth for each of the generations.
+        @param stop_and_ticker: int64 array, backed by shared memory.
+                                element at index=0 indicates whether to execution as been canceled or not.
+                                elements at index>1 will store the best depth for each of the generations.
         """
-        super().__init__(initial=(0, 0), initial_cost=0, extra=0)
+        self.initial = Node(state=(0, 0), node_cost=0, extra=0)
         # initial state -> (depth, hash) -> 0 represents empty world at the start, at zero depth
         # extra -> the sum of entropies of the closed nodes in the current branch ( at the moment they were closed )
 
@@ -189,31 +485,41 @@ class WFC_Problem(Problem):
             return
 
         # BASIC DATA
-        self._stop_and_ticker = stop_and_ticker_shm_list
+        self._stop_and_ticker = stop_and_ticker
         self._pid = pid
         self.rng = np.random.default_rng(seed=seed)
         self._sample: WFC_Sample = sample
         self._relaxed_validation = relax_validation
 
         self._world_tdims = starting_state.shape
-        self._starting_state = starting_state.copy() if non_zeroes > 0 else None
+        self._starting_state = starting_state.astype(NP_ENCODED_TILE_TYPE) if non_zeroes > 0 else None
         # _starting_state has 2 internal uses:
         # 1. if None the center tile is set to open, otherwise the state is iterated to find the tiles at the edges
         # 2. initialize state to return instead of reverting last node actions
 
         # KEEP TRACK OF OPEN TILES ( yet to explore after the last closed node )
-        self._temp_world_open_tiles: set[Index2D] = set([])
+        self._temp_world_open_mask: ndarray = np.zeros(starting_state.shape[:2], dtype=np.uint8)
         """
-        Keeps track of the tiles left to explore in the world.
+        Keeps track of the tiles left to explore in the world; set to 1 at the open positions.
         Avoids recomputing the entire boundary when updating the world state.
         Note: it is updated per action done/undone between two different nodes being processed.
                 likely has room for improvement.
         """
-        self._temp_world_state = starting_state.copy()  # keeps track of the world state of the node being processed
+        # keeps track of the world state of the node being processed
+        self._temp_world_state = starting_state.astype(NP_ENCODED_TILE_TYPE)
         """
         Keeps track of the world state.
         It's updated when processing a node to reflect that particular solution branch world state.
         """
+        self._cells_data_cache: dict[Index2D, CellPotentialStatesData | None] = {}
+        """
+        The potential states & entropy of the cells evaluated in prior successors calls, for the current world state.
+        A cell's data depends on the tiles within a 5x5 region (3x3 w/ relaxed validation),
+        so the entries within that distance of a changed tile are invalidated; see _invalidate_cells_data.
+        """
+        radius = 1 if relax_validation else 2
+        self._cells_data_invalidation_offsets: list[Index2D] = [
+            (dy, dx) for dy in range(-radius, radius + 1) for dx in range(-radius, radius + 1)]
 
         # INFLUENCE COST WEIGHTS & FINAL NODE VALUE
         # influences the nodes' costs. high temperature lowers the influence of random noise and frequency adjustments
@@ -235,48 +541,81 @@ class WFC_Problem(Problem):
         Set to true when all the tiles are filled OR when a plateau is reached.
         """
 
-        # setup data and functions to use 4 or 8 cardinals
+        # setup data to use 4 or 8 cardinals
         self._use_8cardinals = use_8_cardinals
-        self.get_cell_potential_states: Callable[..., dict[TileType, int]] = (
-            self.get_cell_potential_states_8cardinals if use_8_cardinals
-            else self.get_cell_potential_states_4cardinals
-        )
+        self._adjacent_offsets = ADJACENT_OFFSETS_8 if use_8_cardinals else ADJACENT_OFFSETS_4
+        self._roi_slots: ndarray = np.arange(9) if use_8_cardinals else np.array([1, 3, 4, 5, 7])
         """
-        Function that will get the potential states for a given cell. Will be different depending on used cardinals. 
+        The super tile slots, [0->tl, ..., 8->br], that belong in the roi. I.e. all when using 8 cardinals,
+        or all except the corners when using 4. Used to validate a tile given its neighbors.
         """
-        self._reverse_roi_kernel_indices: list[TileType] = (
-            sorted([i for i in range(9) if i not in [1, 3, 4, 5, 7]], reverse=True)
-            if not use_8_cardinals  # i.e. if using 4 cardinals remove corners
-            else []
-        )
+        self._adjacent_slots: ndarray = self._roi_slots[self._roi_slots != 4]
         """
-        The indices that do not belong in the roi. I.e. The corners when using 4 cardinals, or none when using 8.
-        The indices are sorted in descending order.
+        The roi slots without the center. Their order matches the order of the adjacent_tiles_coords indices.
         """
-        self._is_tile_valid: Callable[..., bool] = (
-            self._is_tile_valid_8cardinals
-            if use_8_cardinals
-            else self._is_tile_valid_4cardinals
-        )
+        h, w = starting_state.shape[:2]
+        self._adjacent_coords: dict[Index2D, list[Index2D]] = {
+            (y, x): [(y + dy, x + dx) for dy, dx in self._adjacent_offsets] for y in range(h) for x in range(w)}
         """
-        Verifies if a tile is valid for a given set of neighbors. Zeroes are used as wildcards.
+        The coordinates of the tiles adjacent to each world position, including out of bounds "tiles";
+        see adjacent_tiles_coords.
         """
+        self._adjacent_coords_within_bounds: dict[Index2D, list[Index2D]] = {
+            pos: [(y, x) for y, x in coords if 0 <= y < h and 0 <= x < w]
+            for pos, coords in self._adjacent_coords.items()}
 
         # setup other functions
         self._update_state: Callable[[Node, Node], None] = self._zero_depth_setup
         """
-        Receives the node to process and updates _temp_world_state and _temp_world_open_tiles.
+        Receives the node to process and updates _temp_world_state and _temp_world_open_mask.
         It is called at the start of the successors function.
         Runs _zero_depth_setup on the 1st execution and then replaces it with _update_world_and_temperature.
         """
 
+        # SUPER TILES BITMASKS
+        (self._tile_hashes, self._tile_index, self._super_tiles_indices, self._super_tiles_counts,
+         self._super_tiles_masks, self._super_tiles_spans) = sample.get_super_tiles_tables()
+        """
+        _super_tiles_indices: (S, 9) matrix with the flattened super tiles, using tile indices instead of hashes
+        _super_tiles_masks: (9, T, W64) uint64 bitmasks; the set bits of [slot, tile] are the super tiles
+                            that have the tile at the given slot
+        """
+        self._all_super_tiles_mask = np.bitwise_or.reduce(self._super_tiles_masks[4], axis=0)
+
+        # ZOBRIST KEYS
+        self._zobrist_position_keys = self.rng.spawn(1)[0].integers(
+            0, 1 << 64, size=starting_state.shape[:2], dtype=np.uint64)
+        """
+        Random 64-bit keys per [y, x], drawn from a child generator so that self.rng's stream is unaffected.
+        Mixed with the tile indices to obtain the actions' keys; see zobrist_keys.
+        """
+
         # OTHERS
         tile_data = sample.get_tile_data()
-        self._tile_counts = dict(zip(tile_data.keys(), [0] * len(tile_data)))
+        self._sample_freqs = np.fromiter((tile_data[t][1] for t in self._tile_hashes), dtype=np.float64,
+                                         count=len(self._tile_hashes))
+        """
+        The frequency of each tile type in the sample; indexed by tile index, see _tile_index
+        """
+        self._tile_counts = np.zeros(len(self._tile_hashes), dtype=np.int64)
+        """
+        The number of each tile type in the world state; indexed by tile index, see _tile_index
+        """
         if self._starting_state is not None:
-            for tile in self._starting_state.flat:
-                if tile != 0:
-                    self._tile_counts[tile] += 1
+            tiles, counts = np.unique(self._starting_state[self._starting_state != 0], return_counts=True)
+            for tile, tile_count in zip(tiles.tolist(), counts.tolist()):
+                self._tile_counts[self._tile_index[tile]] += tile_count
+
+        # MEMOIZATION
+        # kept per instance, instead of decorating the methods, so that the caches are freed along with the problem
+        self._tiles_validity_cache: dict[tuple[TileType, ...], bool] = {}
+        """ see _is_tile_valid """
+        self._potential_states_cache: dict[tuple[TileType, ...], dict[TileType, int]] = {}
+        """ see get_cell_potential_states """
+        self._probabilities_and_entropy_cache: dict[tuple, CellPotentialStatesData] = {}
+        """ see _probabilities_and_entropy """
+        self._tile_freq_adjustments_cache: dict[int, float] = {}
+        """ see _tile_freq_adjustment_func """
 
         self._max_freq_adjust = max_freq_adjust
         t = self._number_of_tiles_to_process
@@ -287,7 +626,12 @@ class WFC_Problem(Problem):
     def generation_aborted(self) -> bool:
         return self._stop_and_ticker is not None and self._stop_and_ticker[0]
 
-    @lru_cache(maxsize=8)
+    def set_stop_and_ticker(self, stop_and_ticker: ndarray | None) -> None:
+        """
+        @param stop_and_ticker: see __init__; set to None to release the view of the shared memory.
+        """
+        self._stop_and_ticker = stop_and_ticker
+
     def temp_ratio(self, node_depth: int, prior_node_depth: int):
         # TODO -> potentially something to change/customize
         depth_diff = prior_node_depth - node_depth
@@ -301,22 +645,13 @@ class WFC_Problem(Problem):
         ratio = self.temp_ratio(node_depth, prior_node_depth)
         return limit * ratio + self._min_temperature * (1 - ratio)
 
-    @lru_cache(maxsize=32)
     def _tile_freq_adjustment_func(self, depth):
-        return self._max_freq_adjust * (1 - self._tile_freq_adjustment_poly(depth) / self._number_of_tiles_to_process)
-
-    @lru_cache(maxsize=32)
-    def _cached_adjacent_tiles_coords(self, tile_y: int, tile_x: int) -> list[Index2D]:
-        """
-        Will also fetch the diagonal adjacent tiles if _use_8cardinals is set to true.
-        @return: a list of tuple pairs with the coordinates of the tiles adjacent to the input tile
-                 out of bounds "tiles" coordinates are also returned.
-        """
-        return [(adj_y, adj_x) for adj_y in range(tile_y - 1, tile_y + 2)
-                for adj_x in range(tile_x - 1, tile_x + 2)
-                if (adj_y, adj_x) != (tile_y, tile_x)
-                and (self._use_8cardinals or (adj_y == tile_y or adj_x == tile_x))
-                ]
+        adjustment = self._tile_freq_adjustments_cache.get(depth)
+        if adjustment is None:
+            adjustment = self._max_freq_adjust * (
+                    1 - self._tile_freq_adjustment_poly(depth) / self._number_of_tiles_to_process)
+            self._tile_freq_adjustments_cache[depth] = adjustment
+        return adjustment
 
     def _within_world_bounds(self, tile_y, tile_x):
         return 0 <= tile_y < self._temp_world_state.shape[0] and 0 <= tile_x < self._temp_world_state.shape[1]
@@ -326,13 +661,11 @@ class WFC_Problem(Problem):
         @param exc_out: exclude indices outside the world bounds?
         @return: a list of tuple pairs with the coordinates of the tiles adjacent to the input tile
         """
-        adjacent_idx = self._cached_adjacent_tiles_coords(tile_y, tile_x)
         if exc_out:
-            return [idx for idx in adjacent_idx if self._within_world_bounds(*idx)]
-        return adjacent_idx
+            return self._adjacent_coords_within_bounds[tile_y, tile_x]
+        return self._adjacent_coords[tile_y, tile_x]
 
     @property
-    @cache
     def _3x3_adjacency_kernel(self):
         kernel = np.ones((3, 3)) if self._use_8cardinals else np.array([0, 1, 0, 1, 1, 1, 0, 1, 0]).reshape((3, 3))
         kernel[1, 1] = 0
@@ -352,22 +685,22 @@ class WFC_Problem(Problem):
 
     def close_node(self, y: int, x: int):
         indices_to_check = self.adjacent_tiles_coords(y, x, exc_out=True)
-        self._temp_world_open_tiles.remove((y, x))
+        self._temp_world_open_mask[y, x] = 0
         for _y, _x in indices_to_check:
             if self._temp_world_state[_y, _x] == 0:
-                self._temp_world_open_tiles.add((_y, _x))
+                self._temp_world_open_mask[_y, _x] = 1
 
     def reopen_node(self, y: int, x: int):
         indices_to_check = self.adjacent_tiles_coords(y, x, exc_out=True)
-        self._temp_world_open_tiles.add((y, x))
+        self._temp_world_open_mask[y, x] = 1
         for (_y, _x) in indices_to_check:
-            if not self._temp_world_open_tiles.__contains__((_y, _x)):
+            if not self._temp_world_open_mask[_y, _x]:
                 continue
             sub_indices_to_check = self.adjacent_tiles_coords(_y, _x, exc_out=True)
             if any(self._temp_world_state[__y, __x] != 0 for (__y, __x) in sub_indices_to_check):
                 continue  # -> position should remain open
             # otherwise -> position should be closed
-            self._temp_world_open_tiles.remove((_y, _x))
+            self._temp_world_open_mask[_y, _x] = 0
 
     def reopen_node_v2(self, y: int, x: int):
         """
@@ -375,7 +708,7 @@ class WFC_Problem(Problem):
         """
         from scipy.signal import convolve2d
 
-        self._temp_world_open_tiles.add((y, x))
+        self._temp_world_open_mask[y, x] = 1
 
         # use convolution to check adjacency
         kernel = self._3x3_adjacency_kernel
@@ -390,70 +723,24 @@ class WFC_Problem(Problem):
                 if (
                         # ugly, but using np.argwhere to build indices seems slower
                         (_y == y and _x == x)
-                        or not self._temp_world_open_tiles.__contains__((_y, _x))
+                        or not self._temp_world_open_mask[_y, _x]
                         or (not self._use_8cardinals and kernel[_y - y + 1, _x - x + 1] == 0)
                         or conv_matrix[i, j] > 0
                 ):
                     continue
-                self._temp_world_open_tiles.remove((_y, _x))
-
-    # region validate super tile config for the given set of rules
-
-    @staticmethod
-    def _is_an_impossible_strait_cross(super_tile, p2, p4, p6, p8):
-        """
-        Could the super_tile exist given the partial adjacency configuration set by p2, p4, p6 and p8 ?
-        p1 .. p9 are the tiles in a 3x3 super tile, where p5 is the center.
-        @return: True if impossible, False if possible.
-        """
-        return (
-                p2 != 0 and super_tile[0, 1] != p2 or
-                p4 != 0 and super_tile[1, 0] != p4 or
-                p6 != 0 and super_tile[1, 2] != p6 or
-                p8 != 0 and super_tile[2, 1] != p8
-        )
+                self._temp_world_open_mask[_y, _x] = 0
 
-    @staticmethod
-    def is_an_impossible_diagonal_cross(super_tile, p1, p3, p7, p9):
+    def _is_tile_valid(self, *roi_states: TileType) -> bool:
         """
-        Could the super_tile exist given the partial adjacency configuration set by p1, p3, p7, p9 ?
-        p1 .. p9 are the tiles in a 3x3 super tile, where p5 is the center.
-        @return: True if impossible, False if possible.
+        Verifies if a tile is valid for a given set of neighbors. Zeroes are used as wildcards.
+        @param roi_states: the states at the _roi_slots of the 3x3 region centered on the tile
         """
-        return (
-                p1 != 0 and super_tile[0, 0] != p1 or
-                p3 != 0 and super_tile[0, 2] != p3 or
-                p7 != 0 and super_tile[2, 0] != p7 or
-                p9 != 0 and super_tile[2, 2] != p9
-        )
-
-    @cache
-    def _is_tile_valid_4cardinals(self, p2, p4, p5, p6, p8):
-        """[p1->tl, ..., p9->br] ; where p5 is the center tile"""
-        super_tile_data = self._sample.get_super_tile_data()
-
-        def is_possible(super_tile):
-            return not (
-                    super_tile[1, 1] != p5 or
-                    WFC_Problem._is_an_impossible_strait_cross(super_tile, p2, p4, p6, p8)
-            )
-
-        return any(is_possible(stile) for stile, _ in super_tile_data)
-
-    @cache
-    def _is_tile_valid_8cardinals(self, p1, p2, p3, p4, p5, p6, p7, p8, p9):
-        super_tile_data = self._sample.get_super_tile_data()
-
-        def is_possible(super_tile):
-            return not (
-                    super_tile[1, 1] != p5 or
-                    WFC_Problem._is_an_impossible_strait_cross(super_tile, p2, p4, p6, p8) or
-                    WFC_Problem.is_an_impossible_diagonal_cross(super_tile, p1, p3, p7, p9)
-            )
-
-        return any(is_possible(stile) for stile, _ in super_tile_data)
-
-    # endregion
+        is_valid = self._tiles_validity_cache.get(roi_states)
+        if is_valid is None:
+            domain = self._super_tiles_domain(self._roi_slots, roi_states)
+            is_valid = domain is not None and bool(domain.any())
+            self._tiles_validity_cache[roi_states] = is_valid
+        return is_valid
 
     def validate_adjacent(self, tile_data: dict[TileType, int], world_state: ndarray,
                           indices_to_check: list[Index2D], wy: int, wx: int) -> dict[TileType, int]:
@@ -480,11 +767,8 @@ class WFC_Problem(Problem):
                     continue
 
                 sub_roi_3x3 = roi_matrix[y_center - 1:y_center + 2, x_center - 1:x_center + 2]
-                adjacent_states = sub_roi_3x3.flatten().tolist()
-                for index in self._reverse_roi_kernel_indices:  # remove corners if using 4 cardinals
-                    del adjacent_states[index]
-
-                if not self._is_tile_valid(*adjacent_states):
+                roi_states = sub_roi_3x3.flat[self._roi_slots].tolist()  # excludes corners if using 4 cardinals
+                if not self._is_tile_valid(*roi_states):
                     return False
 
             return True
@@ -492,73 +776,97 @@ class WFC_Problem(Problem):
         new_tile_data = {k: c for k, c in tile_data.items() if check_if_all_adjacent_tiles_remain_valid_v2(k)}
         return new_tile_data
 
-    @cache
-    def get_cell_potential_states_8cardinals(self, p1: TileType, p2, p3, p4, p6, p7, p8, p9) -> dict[TileType, int]:
+    def _super_tiles_domain(self, slots, tiles) -> ndarray | None:
         """
-        the state of adjacent cells; where 0 = unknown
-        [[1,2,3],
-         [4,c,6],
-         [7,8,9]]
-        @return: dictionary with tile types' counts
+        Intersects the super tiles' bitmasks of the known tiles (non-zeroes) at the given super tile slots.
+        @param slots: super tile flat indices, [0->tl, ..., 8->br]
+        @param tiles: the tile types at the respective slots; where 0 = unknown
+        @return: the bitmask with the super tiles that match all the known tiles;
+                 or None if a known tile is not present in the sample.
         """
-
-        def is_possible(super_tile):
-            tiles = np.array([[p1, p2, p3], [p4, 0, p6], [p7, p8, p9]])
-            for (y, x), tile in np.ndenumerate(tiles):
-                # print(f"super={super_tile} ;  index = {(y,x)}")
-                if tile == 0:
-                    continue
-                if super_tile[y, x] != tile:
-                    return False
-            return True
-
-        # filter all the possible super tiles
-        pcs = defaultdict(int)
-        for stile, count in self._sample.get_super_tile_data():
-            if is_possible(stile):
-                pcs[stile[1, 1]] += count
-
-        return pcs
-
-    @cache
-    def get_cell_potential_states_4cardinals(self, p2: TileType, p4, p6, p8) -> dict[TileType, int]:
+        known_slots, known_tiles = [], []
+        for slot, tile in zip(slots, tiles):
+            if tile == 0:
+                continue
+            tile_index = self._tile_index.get(tile)
+            if tile_index is None:
+                return None
+            known_slots.append(slot)
+            known_tiles.append(tile_index)
+
+        if not known_slots:
+            return self._all_super_tiles_mask
+        return intersect_super_tiles_masks(self._super_tiles_masks, self._super_tiles_spans,
+                                           np.array(known_slots, dtype=np.intp), np.array(known_tiles, dtype=np.intp))
+
+    def _center_tiles_counts(self, domain: ndarray | None) -> dict[TileType, int]:
         """
-        Read get_cell_potential_states_8cardinals documentation.
-        This function is similar, but only takes into account 4 cardinals
+        @param domain: bitmask of super tiles, obtained via _super_tiles_domain
+        @return: dictionary with the domain's center tile types' counts, ordered by first occurrence in the sample
         """
+        if domain is None or not domain.any():
+            return {}
 
-        def is_possible(super_tile):
-            tiles = np.array([[0, p2, 0], [p4, 0, p6], [0, p8, 0]])
-            for (y, x), tile in np.ndenumerate(tiles):
-                if tile == 0:
-                    continue
-                if super_tile[y, x] != tile:
-                    return False
-            return True
-
-        # filter all the possible super tiles
-        pcs = defaultdict(int)
-        for stile, count in self._sample.get_super_tile_data():
-            if is_possible(stile):
-                pcs[stile[1, 1]] += count
+        center_tiles, counts = count_center_tiles(domain, self._super_tiles_indices, self._super_tiles_counts,
+                                                  len(self._tile_hashes))
+        tile_hashes = self._tile_hashes
+        return {tile_hashes[t]: c for t, c in zip(center_tiles.tolist(), counts[center_tiles].tolist())}
 
+    def get_cell_potential_states(self, *adjacent_states: TileType) -> dict[TileType, int]:
+        """
+        @param adjacent_states: the state of adjacent cells, at the _adjacent_slots; where 0 = unknown
+        [[0,1,2],
+         [3,c,5],
+         [6,7,8]]
+        @return: dictionary with tile types' counts
+        """
+        pcs = self._potential_states_cache.get(adjacent_states)
+        if pcs is None:
+            pcs = self._center_tiles_counts(self._super_tiles_domain(self._adjacent_slots, adjacent_states))
+            self._potential_states_cache[adjacent_states] = pcs
         return pcs
 
     @staticmethod
     def map_to_probabilities(pcs: dict[TileType, int]) -> tuple[list[TileType], ndarray] | None:
         """
-        @param pcs: Dict[ key->tile_type, value->count ]  obtained from get_cell_potential_states_Xcardinals.
+        @param pcs: Dict[ key->tile_type, value->count ]  obtained from get_cell_potential_states.
         @return: tile types and their respective probabilities (shared index), where probability is normalized [0, 1].
             If pcs is empty then returns None, None
         """
         if not pcs:
             return None
 
-        counts = np.array(list(pcs.values()), dtype=np.float32)
+        counts = np.fromiter(pcs.values(), dtype=np.float32, count=len(pcs))
         probabilities = counts / counts.sum()
 
         return list(pcs.keys()), probabilities
 
+    def _probabilities_and_entropy(self, pcs_items: tuple[tuple[TileType, int], ...]) -> CellPotentialStatesData:
+        """
+        Cells often share the same potential states, so these are only computed once per distinct set of counts.
+        @param pcs_items: the (tile type, count) items of a non-empty dict obtained from get_cell_potential_states
+        @return: tile types, their probabilities (read-only), the entropy, the normalized entropy,
+                 and the tile types' indices (read-only).
+                 If there's only one tile type, the entropy is zero and the normalized entropy None.
+        """
+        cell_data = self._probabilities_and_entropy_cache.get(pcs_items)
+        if cell_data is not None:
+            return cell_data
+
+        tile_types, probabilities = self.map_to_probabilities(dict(pcs_items))
+        probabilities.flags.writeable = False
+        tile_indices = np.fromiter((self._tile_index[t] for t in tile_types), dtype=np.intp, count=len(tile_types))
+        tile_indices.flags.writeable = False
+
+        if len(probabilities) == 1:
+            cell_data = tile_types, probabilities, 0.0, None, tile_indices
+        else:
+            entropy = - np.sum(probabilities * np.log2(probabilities))
+            normalized_entropy = min(1.0, entropy / np.log2(len(probabilities)))
+            cell_data = tile_types, probabilities, entropy, normalized_entropy, tile_indices
+        self._probabilities_and_entropy_cache[pcs_items] = cell_data
+        return cell_data
+
     def node_value(self, node: Node):
         return (
             # depth: can be used to prioritize nodes w/ high depth for a quicker generation
@@ -582,7 +890,6 @@ class WFC_Problem(Problem):
         self._get_world_state(last_node, current_node)
 
     def successors(self, node):
-        from py_search.base import Node
         """
         Generate all possible next states
         """
@@ -601,32 +908,35 @@ class WFC_Problem(Problem):
         if self._search_completed(depth) or self._search_plateaued():
             return
 
+        # collect the open cells' potential states before computing any costs.
+        # a cell with zero entropy is collapsed right away, so the costs of the other cells are never needed.
         potential_collapses: list[tuple[Index2D, CellPotentialStatesData]] = []
-        for (y, x) in self._temp_world_open_tiles:
-            states, costs, entropy = self._get_cell_potential_states_and_costs(y, x, self._temp_world_state, depth)
-
-            if entropy is None:
+        cells_data_cache = self._cells_data_cache
+        open_ys, open_xs = np.nonzero(self._temp_world_open_mask)
+        for y, x in zip(open_ys.tolist(), open_xs.tolist()):
+            if (y, x) in cells_data_cache:
+                cell_data = cells_data_cache[y, x]
+            else:
+                cell_data = self._get_cell_potential_states_and_entropy(y, x, self._temp_world_state)
+                cells_data_cache[y, x] = cell_data
+
+            if cell_data is None:
                 # if there are no possible states for a cell, this is an impossible state
                 # further computations on this node are not needed, abort this search branch
                 # note that the node as been closed, but updating the cost could help w/ debugging
                 node.node_cost = float("inf")
                 return
 
-            potential_collapses.append(
-                (
-                    (y, x),
-                    (states, costs, entropy)
-                )
-            )
-
-            if entropy <= 0.0:
+            if cell_data[2] <= 0.0:
                 # if entropy is 0, then this cell only has a possible state
                 # collapse it, and abort other search branches coming out of this node
-                potential_collapses = [potential_collapses[-1]]
+                potential_collapses = [((y, x), cell_data)]
                 break
 
+            potential_collapses.append(((y, x), cell_data))
+
         # check if last is impossible
-        if len(potential_collapses) == 0:  # or potential_collapses[-1][1][2] is None:
+        if len(potential_collapses) == 0:
             node.node_cost = float("inf")  # the node has now been closed, but it could help w/ debugging
             return
 
@@ -634,15 +944,17 @@ class WFC_Problem(Problem):
         #      f"freq_depth_adjustment={self._tile_freq_adjustment_func(depth):6,.2f}  |  "
         #      f"open tiles:{len(iyxs):5,.0f}    ", end="\r")
 
-        boundary_avg_entropy = sum(e for _, (_, _, e) in potential_collapses) / len(
+        boundary_avg_entropy = sum(cell_data[2] for _, cell_data in potential_collapses) / len(
             potential_collapses)  # will be lagging by one state
 
-        for (y, x), (potential_states, costs, entropy) in potential_collapses:
+        for (y, x), (potential_states, probabilities, _, normalized_entropy, tile_indices) in potential_collapses:
+            costs = self._get_costs(probabilities, normalized_entropy, tile_indices, depth)
             items = zip(potential_states, costs)
             # TODO prune search -> temperature based pruning has not been implemented yet
-            for tile_type, cost in items:
+            keys = zobrist_keys(self._zobrist_position_keys[y, x], tile_indices).tolist()
+            for (tile_type, cost), key in zip(items, keys):
                 action: WFC_Action = ((y, x), tile_type)
-                state = node.state[1] ^ hash(action)  # zobrist like
+                state = node.state[1] ^ key  # zobrist hashing
                 yield Node(state=(depth + 1, state), parent=node, action=action, node_cost=cost,
                            extra=boundary_avg_entropy)
 
@@ -672,7 +984,11 @@ class WFC_Problem(Problem):
                 self._prev_best_depth = self._best_node.depth()
         return False
 
-    def _get_cell_potential_states_and_costs(self, y, x, world_state, depth) -> CellPotentialStatesData:
+    def _get_cell_potential_states_and_entropy(self, y, x, world_state) -> CellPotentialStatesData | None:
+        """
+        @return: the cell's potential states, their probabilities and the cell's entropy;
+                 or None if there are no potential states.
+        """
         adjacent_indices = self.adjacent_tiles_coords(y, x, exc_out=False)
         adjacent_states = [0 if not self._within_world_bounds(*idx)
                            else world_state[idx[0], idx[1]]
@@ -683,51 +999,61 @@ class WFC_Problem(Problem):
         if not self._relaxed_validation:
             potential_tiles_data = self.validate_adjacent(potential_tiles_data, world_state, adjacent_indices, y, x)
 
-        # using the stored sample counts, compute each tile type probability
-        tile_types, probabilities = self.map_to_probabilities(potential_tiles_data) or ([], None)
+        if not potential_tiles_data:
+            return None
+
+        # using the stored sample counts, compute each tile type probability & the cell's entropy
+        return self._probabilities_and_entropy(tuple(potential_tiles_data.items()))
 
-        if probabilities is None:
-            return [], None, None  # nothing to compute, so just return early
+    def _get_costs(self, probabilities, normalized_entropy, tile_indices, depth) -> ndarray:
+        """
+        @return: the costs of collapsing a cell into each of its potential states (given by their tile_indices)
+        """
+        if len(probabilities) == 1:
+            # collapse -> only one possibility
+            return 1 - probabilities
 
-        # generate random weights and temperature
-        rands = self.rng.random(len(probabilities))
-        temp = 1 - self.rng.integers(low=int(self._min_temperature), high=100) / 100.0
+        # generate random weights and temperature, w/ a single draw
+        rands = self.rng.random(len(probabilities) + 1)
+        min_temp = int(self._min_temperature)
+        temp = 1 - (min_temp + int(rands[-1] * (100 - min_temp))) / 100.0  # same as integers(min_temp, 100)
+        rands = rands[:-1]
 
         # GET tile type freq in original samples AND in current generation
-        tile_data = self._sample.get_tile_data()
-        sample_freqs = np.array([tile_data[t][1] for t in tile_types])
-        current_counts = np.array([self._tile_counts[t] for t in tile_types])
-        current_freqs = current_counts / max(1, depth)
-
-        if np.isclose(self._max_freq_adjust, 0.0, rtol=0.0, atol=1.e-8):
-            adjusted_freqs_diff = np.zeros(probabilities.size)
-        else:
-            depth_adjustment = self._tile_freq_adjustment_func(depth)
-            adjusted_freqs_diff = np.sign(sample_freqs - current_freqs) * (
-                    1 - np.minimum(sample_freqs, current_freqs) / np.maximum(sample_freqs, current_freqs))
-            adjusted_freqs_diff *= depth_adjustment
+        sample_freqs = self._sample_freqs[tile_indices]
+        current_freqs = self._tile_counts[tile_indices] / max(1, depth)
 
-        # compute entropy and node costs
-        if len(probabilities) == 1:
-            # collapse -> only one possibility
-            entropy = 0.0
-            costs = 1 - probabilities
-        else:
-            entropy = - np.sum(probabilities * np.log2(probabilities))
-            normalized_entropy = min(1.0, entropy / np.log2(len(probabilities)))
-            costs = (1 - np.clip(probabilities
-                                 + adjusted_freqs_diff * temp * normalized_entropy
-                                 + (rands * 2 - 1) * temp * normalized_entropy
-                                 , 0.0001, 1))
+        depth_adjustment = 0.0 if np.isclose(self._max_freq_adjust, 0.0, rtol=0.0, atol=1.e-8) \
+            else self._tile_freq_adjustment_func(depth)
+        return self._compute_costs(probabilities, normalized_entropy, sample_freqs, current_freqs,
+                                   rands, temp, depth_adjustment)
 
-        return tile_types, costs, entropy
+    @staticmethod
+    def _compute_costs(probabilities, normalized_entropy, sample_freqs, current_freqs, rands, temp, depth_adjustment):
+        """
+        @return: 1 - clip(probabilities + (adjusted freqs diff * depth_adjustment + noise) * temp * normalized_entropy)
+        """
+        # sign(s - c) * (1 - min(s, c) / max(s, c)) is the same as (s - c) / max(s, c), w/ a single division
+        freqs_max = np.maximum(sample_freqs, current_freqs)
+        adjusted = np.subtract(sample_freqs, current_freqs)
+        np.divide(adjusted, freqs_max, out=adjusted, where=freqs_max > 0)
+        adjusted *= depth_adjustment
+
+        # reuses the noise buffer: rands in [0, 1[ -> noise in [-1, 1[
+        costs = np.multiply(rands, 2, out=rands)
+        costs -= 1
+        costs += adjusted
+        costs *= temp * normalized_entropy
+        costs += probabilities
+        np.clip(costs, 0.0001, 1, out=costs)
+        return np.subtract(1, costs, out=costs)
 
     def _get_world_state(self, last_node: Node, current_node: Node) -> None:
         """
-        Updates _temp_world_state and _temp_world_open_tiles to reflect current_node solution branch state.
+        Updates _temp_world_state and _temp_world_open_mask to reflect current_node solution branch state.
 
         Rollback actions from last_node solution branch if depth is maintained or increased
-        until a common ancestor is found (at worst, zero depth node is common to all branches).
+        until the common ancestor is found (at worst, zero depth node is common to all branches).
         Then, apply actions starting from the common ancestor till the current_node is reached.
         """
         start_depth = min(last_node.depth(), current_node.depth())
@@ -739,23 +1065,17 @@ class WFC_Problem(Problem):
             self._revert_action(p_node.action)
             p_node = p_node.parent
 
+        # NOTE: node is removed from opened set when closing; thus, the order of operations needs to be preserved
+        nodes_to_apply = []
         for _ in range(c_node.depth() - start_depth):
+            nodes_to_apply.append(c_node)
             c_node = c_node.parent
 
-        common_depth = 0
-        for i in range(start_depth + 1)[::-1]:
-            if p_node.state == c_node.state:  # hashes may collide, so albeit rare, this may trigger an error later when updating open tiles
-                common_depth = i
-                break
+        # nodes are compared by identity, not by state, so hashcode collisions can't yield a wrong common ancestor
+        while p_node is not c_node:
             self._revert_action(p_node.action)
-            p_node = p_node.parent
-            c_node = c_node.parent
-
-        # NOTE: node is removed from opened set when closing; thus, the order of operations needs to be preserved
-        c_node = current_node
-        nodes_to_apply = []
-        for _ in range(current_node.depth() - common_depth):
             nodes_to_apply.append(c_node)
+            p_node = p_node.parent
             c_node = c_node.parent
 
         for node in nodes_to_apply[::-1]:
@@ -764,32 +1084,41 @@ class WFC_Problem(Problem):
     def _open_nodes_on_depth_zero(self):
         if self._starting_state is None:
             # open center tile
-            self._temp_world_open_tiles.add((self._world_tdims[0] // 2, self._world_tdims[1] // 2))
+            self._temp_world_open_mask[self._world_tdims[0] // 2, self._world_tdims[1] // 2] = 1
             return
-        # otherwise -> find all in starting state
-        wost = self._temp_world_open_tiles
-        for (y, x), tile in np.ndenumerate(self._starting_state):
-            if tile != 0:
-                continue
-            indices_to_check = self.adjacent_tiles_coords(y, x)
-            if any(self._starting_state[__y, __x] != 0 for (__y, __x) in indices_to_check):
-                wost.add((y, x))
+        # otherwise -> find all in starting state, i.e. the empty tiles w/ a filled adjacent tile
+        filled = self._starting_state != 0
+        h, w = filled.shape
+        padded = np.pad(filled, 1)
+        has_filled_adjacent = np.zeros_like(filled)
+        for dy, dx in self._adjacent_offsets:
+            has_filled_adjacent |= padded[1 + dy:1 + dy + h, 1 + dx:1 + dx + w]
+        self._temp_world_open_mask[~filled & has_filled_adjacent] = 1
 
     def _revert_action(self, node_action: WFC_Action) -> None:
-        pos, _ = node_action
-        self._tile_counts[self._temp_world_state[*pos]] -= 1
+        pos, tile_type = node_action
+        self._tile_counts[self._tile_index[tile_type]] -= 1
         self._temp_world_state[*pos] = 0
+        self._invalidate_cells_data(*pos)
         self.reopen_node(*pos)
 
     def _apply_action(self, node_action: WFC_Action) -> None:
         (pos, tile_type) = node_action
         self._temp_world_state[*pos] = tile_type
-        self._tile_counts[tile_type] += 1
+        self._tile_counts[self._tile_index[tile_type]] += 1
+        self._invalidate_cells_data(*pos)
         self.close_node(*pos)
 
+    def _invalidate_cells_data(self, y: int, x: int) -> None:
+        """
+        Removes the cached data of the cells that may depend on the tile at the given position.
+        """
+        cells_data_cache = self._cells_data_cache
+        for dy, dx in self._cells_data_invalidation_offsets:
+            cells_data_cache.pop((y + dy, x + dx), None)
+
     def _prune_search(self, items):
         print("Search pruning based on temperature has not been fully implemented")
-        from _operator import itemgetter
 
         if self._min_temperature < self.temperature_thresh:
             return items
@@ -805,18 +1134,47 @@ class WFC_Problem(Problem):
 
     def get_solution_state(self):
         node: Node = self._best_node
-        encoded_state = np.zeros(self._temp_world_state.shape[:2]) if self._starting_state is None \
-            else self._starting_state.copy()
+        encoded_state = np.zeros(self._temp_world_state.shape[:2], dtype=NP_ENCODED_TILE_TYPE) \
+            if self._starting_state is None else self._starting_state.astype(NP_ENCODED_TILE_TYPE)
+        actions = []
         for _ in range(node.depth()):
-            (y, x), tile_hash = node.action
+            actions.append(node.action)
             node = node.parent
-            if tile_hash != 0:
-                encoded_state[y, x] = tile_hash
 
-        return encoded_state.astype(NP_ENCODED_TILE_TYPE)
+        if actions:  # each position is only collapsed once per branch, so the actions can be applied in any order
+            positions, tile_hashes = zip(*actions)
+            ys, xs = zip(*positions)
+            encoded_state[ys, xs] = np.array(tile_hashes, dtype=NP_ENCODED_TILE_TYPE)  # may not fit int64
+        return encoded_state
 
     def goal_test(self, state_node, goal_node=None):
         # state is not kept in each node, so the checks are done when closing a node.
         # goal_test is only defined to terminate the search;
         # the real goal test is done in the successors method
         return self._stop_search
+
+
+def best_first_search(problem: WFC_Problem):
+    """
+    Graph best-first search over the problem's nodes, minimizing problem.node_value.
+    Nodes with the same value are popped by highest cost first, and then by the most recently pushed.
+
+    @return: generator that yields the nodes that pass the problem's goal test.
+             StopIteration is raised once there are no nodes left to expand.
+    """
+    tiebreak = count()
+    initial = problem.initial
+    fringe = [(problem.node_value(initial), -initial.cost(), -next(tiebreak), initial)]
+    closed = {initial.state: initial.cost()}
+
+    while fringe:
+        node = heapq.heappop(fringe)[3]
+        if problem.goal_test(node):
+            yield node
+
+        for s in problem.successors(node):
+            s_cost = s.cost()
+            closed_cost = closed.get(s.state)
+            if closed_cost is None or s_cost < closed_cost:
+                heapq.heappush(fringe, (problem.node_value(s), -s_cost, -next(tiebreak), s))
+                closed[s.state] = s_cost